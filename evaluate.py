@@ -21,9 +21,12 @@ global_parser.set_defaults(func=global_analysis.run_analysis)
 
 # Local analysis arguments
 local_parser = subparsers.add_parser('local', help='run local prototypes analysis')
-local_parser.add_argument('--img', type=str, required=True, help='path of an image in the dataset to use for evaluation')
+local_parser.add_argument('--img', type=str, required=True, help='path (or glob pattern) of the images in the dataset to use for evaluation')
+local_parser.add_argument('--batch_size', type=int, default=16, help='number of images forwarded through the model at once (default: %(default)s)')
 local_parser.add_argument('--top_prototypes', type=int, default=20, help='number of most activated prototypes to be displayed (default: %(default)s)')
 local_parser.add_argument('--top_classes', type=int, default=10, help='number of most activated classes for which display the top prototypes (default: %(default)s)')
+local_parser.add_argument('--half', action='store_true', help='run the backbone under fp16 autocast (distances stay in float32)')
+local_parser.add_argument('--compile', action='store_true', help='compile the model with torch.compile before running the analysis')
 local_parser.set_defaults(func=local_analysis.run_analysis)
 
 
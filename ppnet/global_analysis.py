@@ -1,5 +1,6 @@
 import os
 import re
+from pathlib import Path
 from argparse import Namespace
 import numpy as np
 import cv2
@@ -32,8 +33,8 @@ def run_analysis(args: Namespace):
     train_dir = os.path.join(args.dataset, 'train')
     test_dir = os.path.join(args.dataset, 'test')
 
-    model_path = os.path.abspath(args.model)  # ./saved_models/vgg19/003/checkpoints/10_18push0.7822.pth
-    model_base_architecture, experiment_run, _, model_name = re.split(r'\\|/', model_path)[-4:]
+    model_path = Path(args.model).resolve()  # ./saved_models/vgg19/003/checkpoints/10_18push0.7822.pth
+    model_base_architecture, experiment_run, _, model_name = model_path.parts[-4:]
     start_epoch_number = int(re.search(r'\d+', model_name).group(0))
 
     # load the model
@@ -46,8 +47,7 @@ def run_analysis(args: Namespace):
     log(f'Model base architecture: {model_base_architecture}')
     log(f'Experiment run: {experiment_run}\n')
 
-    ppnet = torch.load(args.model)
-    ppnet = ppnet.cuda()
+    ppnet = torch.load(args.model, map_location='cuda')
     ppnet_multi = torch.nn.DataParallel(ppnet)
 
     img_size = ppnet_multi.module.img_size
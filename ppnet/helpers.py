@@ -51,6 +51,23 @@ def find_high_activation_crop(activation_map, percentile=95):
     return lower_y, upper_y+1, lower_x, upper_x+1
 
 
+def find_high_activation_crops(activation_maps, percentile=95):
+    '''
+    batched version of find_high_activation_crop for a tensor of shape
+    (N, H, W), returns a (N, 4) tensor of crop indices
+    '''
+    height, width = activation_maps.shape[1:]
+    # torch.quantile rejects inputs with more than 2**24 elements, so compute it over chunks of maps
+    activation_maps_flat = activation_maps.flatten(start_dim=1)
+    chunk_size = max(1, 2**24 // activation_maps_flat.size(1))
+    threshold = torch.cat([torch.quantile(chunk, percentile / 100, dim=1) for chunk in activation_maps_flat.split(chunk_size)])
+    mask = activation_maps >= threshold.view(-1, 1, 1)
+    rows, cols = mask.any(dim=2).float(), mask.any(dim=1).float()
+    lower_y, upper_y = rows.argmax(dim=1), height - rows.flip(1).argmax(dim=1)
+    lower_x, upper_x = cols.argmax(dim=1), width - cols.flip(1).argmax(dim=1)
+    return torch.stack([lower_y, upper_y, lower_x, upper_x], dim=1)
+
+
 def set_seed(seed):
     torch.manual_seed(seed)
     np.random.seed(seed)
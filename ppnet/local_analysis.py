@@ -1,55 +1,79 @@
 import os
 import re
+import glob
 import copy
+import shutil
+from pathlib import Path
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 from argparse import Namespace
 import numpy as np
 import pandas as pd
 import cv2
 from PIL import Image
-import matplotlib.pyplot as plt
 import torch
 import torch.utils.data
-from torch.autograd import Variable
+import torch.nn.functional as F
 import torchvision.transforms as transforms
 import torchvision.datasets as datasets
 
-from .helpers import makedir, find_high_activation_crop
+from .helpers import makedir, find_high_activation_crops
 from .log import create_logger
 from .preprocess import mean, std, undo_preprocess_input_function
 
 
+def save_png(fname, img):
+    '''
+    save an RGB(A) image, either uint8 or float in [0, 1], as PNG with a low
+    compression level to reduce the encoding time
+    '''
+    if img.dtype != np.uint8:
+        img = np.uint8(255 * np.clip(img, 0, 1))
+    Image.fromarray(img).save(fname, format='PNG', compress_level=3)
+
+
 def save_preprocessed_img(fname, preprocessed_imgs, index=0):
     img_copy = copy.deepcopy(preprocessed_imgs[index:index+1])
     undo_preprocessed_img = undo_preprocess_input_function(img_copy)
     undo_preprocessed_img = undo_preprocessed_img[0]
     undo_preprocessed_img = undo_preprocessed_img.detach().cpu().numpy()
     undo_preprocessed_img = np.transpose(undo_preprocessed_img, [1, 2, 0])
-    plt.imsave(fname, undo_preprocessed_img)
+    save_png(fname, undo_preprocessed_img)
     return undo_preprocessed_img
 
 
+@lru_cache(maxsize=512)
+def load_prototype_img(load_img_dir, epoch, index, kind=''):
+    '''
+    load the RGB image of a prototype saved during push, kind is the suffix of
+    the image type (e.g. '-original'), cached since the same prototypes are
+    loaded for multiple images; the cache is bounded to roughly the images of
+    the prototypes displayed with the default arguments (3 kinds each)
+    '''
+    p_img = Image.open(os.path.join(load_img_dir, 'epoch-'+str(epoch), str(index) + '_prototype-img' + kind + '.png'))
+    p_img = np.asarray(p_img.convert('RGB'))
+    p_img.setflags(write=False)
+    return p_img
+
+
 def save_prototype(load_img_dir, fname, epoch, index):
-    p_img = plt.imread(os.path.join(load_img_dir, 'epoch-'+str(epoch), str(index) + '_prototype-img.png'))
-    plt.axis('off')
-    plt.imsave(fname, p_img)
+    p_img = load_prototype_img(load_img_dir, epoch, index)
+    save_png(fname, p_img)
 
 
 def save_prototype_self_activation(load_img_dir, fname, epoch, index):
-    p_img = plt.imread(os.path.join(load_img_dir, 'epoch-'+str(epoch), str(index) + '_prototype-img-original_with_self_act.png'))
-    plt.axis('off')
-    plt.imsave(fname, p_img)
+    p_img = load_prototype_img(load_img_dir, epoch, index, kind='-original_with_self_act')
+    save_png(fname, p_img)
 
 
 def save_prototype_original_img_with_bbox(load_img_dir, fname, epoch, index,
                                           bbox_height_start, bbox_height_end,
                                           bbox_width_start, bbox_width_end, color=(0, 255, 255)):
-    p_img_bgr = cv2.imread(os.path.join(load_img_dir, 'epoch-'+str(epoch), str(index) + '_prototype-img-original.png'))
+    p_img_bgr = cv2.cvtColor(load_prototype_img(load_img_dir, epoch, index, kind='-original'), cv2.COLOR_RGB2BGR)
     cv2.rectangle(p_img_bgr, (bbox_width_start, bbox_height_start), (bbox_width_end-1, bbox_height_end-1), color, thickness=2)
     p_img_rgb = p_img_bgr[..., ::-1]
-    p_img_rgb = np.float32(p_img_rgb) / 255
-    # plt.imshow(p_img_rgb)
-    plt.imsave(fname, p_img_rgb)
+    save_png(fname, p_img_rgb)
 
 
 def imsave_with_bbox(fname, img_rgb, bbox_height_start, bbox_height_end,
@@ -57,221 +81,340 @@ def imsave_with_bbox(fname, img_rgb, bbox_height_start, bbox_height_end,
     img_bgr_uint8 = cv2.cvtColor(np.uint8(255*img_rgb), cv2.COLOR_RGB2BGR)
     cv2.rectangle(img_bgr_uint8, (bbox_width_start, bbox_height_start), (bbox_width_end-1, bbox_height_end-1), color, thickness=2)
     img_rgb_uint8 = img_bgr_uint8[..., ::-1]
-    img_rgb_float = np.float32(img_rgb_uint8) / 255
-    plt.axis('off')
-    plt.imsave(fname, img_rgb_float)
+    save_png(fname, img_rgb_uint8)
+
+
+# number of prototypes whose activation maps are upsampled and saved at once
+prototype_chunk_size = 64
+
+# files saved by save_prototype_analysis for each prototype
+prototype_analysis_files = ['prototype_patch.png', 'prototype_bbox.png', 'prototype_activation.png',
+                            'target_patch.png', 'target_bbox.png', 'target_activation.png']
+
+
+def save_prototype_analysis(load_img_dir, save_dir, epoch, index, prototype_bbox,
+                            original_img, high_act_patch_indices, overlayed_img):
+    '''
+    save the learned prototype together with its activation on the test image
+    '''
+    makedir(save_dir)
+    save_prototype(load_img_dir, os.path.join(save_dir, 'prototype_patch.png'), epoch, index)
+    save_prototype_original_img_with_bbox(
+        load_img_dir=load_img_dir,
+        fname=os.path.join(save_dir, 'prototype_bbox.png'),
+        epoch=epoch,
+        index=index,
+        bbox_height_start=prototype_bbox[0],
+        bbox_height_end=prototype_bbox[1],
+        bbox_width_start=prototype_bbox[2],
+        bbox_width_end=prototype_bbox[3],
+        color=(0, 255, 255)
+    )
+    save_prototype_self_activation(load_img_dir, os.path.join(save_dir, 'prototype_activation.png'), epoch, index)
+    # show the most highly activated patch of the image by this prototype
+    high_act_patch = original_img[high_act_patch_indices[0]:high_act_patch_indices[1], high_act_patch_indices[2]:high_act_patch_indices[3], :]
+    save_png(os.path.join(save_dir, 'target_patch.png'), high_act_patch)
+    imsave_with_bbox(fname=os.path.join(save_dir, 'target_bbox.png'),
+                     img_rgb=original_img,
+                     bbox_height_start=high_act_patch_indices[0],
+                     bbox_height_end=high_act_patch_indices[1],
+                     bbox_width_start=high_act_patch_indices[2],
+                     bbox_width_end=high_act_patch_indices[3], color=(0, 255, 255))
+    # show the image overlayed with prototype activation map
+    save_png(os.path.join(save_dir, 'target_activation.png'), overlayed_img)
+
+
+def copy_prototype_analysis(src_dir, dst_dir, prefix, rename=None):
+    '''
+    copy the files saved by save_prototype_analysis to dst_dir, rename maps
+    the source file names to different destination names
+    '''
+    rename = rename or {}
+    for fname in prototype_analysis_files:
+        shutil.copyfile(src=os.path.join(src_dir, fname), dst=os.path.join(dst_dir, f'{prefix}_{rename.get(fname, fname)}'))
+
+
+def upsample_activation_patterns(activation_patterns, indices, img_size):
+    '''
+    upsample the activation patterns of the selected prototypes to the input
+    image size with a single batched bicubic interpolation
+    '''
+    indices = torch.as_tensor(indices, device=activation_patterns.device)
+    patterns = activation_patterns.index_select(0, indices).unsqueeze(1)
+    upsampled = F.interpolate(patterns, size=(img_size, img_size), mode='bicubic', align_corners=False)
+    return upsampled.squeeze(1)
+
+
+def overlay_activation_heatmaps(img_rgb, upsampled_activation_patterns):
+    '''
+    overlay the JET heatmaps of a batch of upsampled activation patterns on
+    the given image, computing all of them at once on the patterns' device
+    '''
+    device = upsampled_activation_patterns.device
+    jet_lut = cv2.applyColorMap(np.arange(256, dtype=np.uint8), cv2.COLORMAP_JET)[:, 0, ::-1].copy()
+    jet_lut = torch.as_tensor(jet_lut, device=device)
+    min_act = upsampled_activation_patterns.amin(dim=(1, 2), keepdim=True)
+    max_act = upsampled_activation_patterns.amax(dim=(1, 2), keepdim=True)
+    # rescale in place to avoid allocating a new batch of maps at each step
+    rescaled_activation_patterns = upsampled_activation_patterns - min_act
+    rescaled_activation_patterns.div_((max_act - min_act).clamp_min_(1e-8)).mul_(255)
+    overlayed_imgs = jet_lut[rescaled_activation_patterns.long()].float()
+    img_rgb = torch.as_tensor(img_rgb, device=device)
+    return overlayed_imgs.mul_(0.3 / 255).add_(img_rgb, alpha=0.5)
+
+
+def load_test_img(img_path, img_size):
+    '''
+    load an image letting the JPEG decoder downscale it close to img_size,
+    returns the image together with its original (width, height)
+    '''
+    img_pil = Image.open(img_path)
+    original_size = img_pil.size
+    img_pil.draft('RGB', (img_size, img_size))
+    return img_pil.convert('RGB'), original_size
+
+
+def prefetch_test_batch(batch_paths, preprocess, img_size, stream, pad_to=0):
+    '''
+    load a batch of test images and start copying it to the GPU on the given
+    stream, so that the copy overlaps with the work on the current stream;
+    the batch is padded with zeros up to pad_to images, if given
+    '''
+    imgs_pil, imgs_original_size = zip(*[load_test_img(img_path, img_size) for img_path in batch_paths])
+    imgs_tensor = torch.stack([preprocess(img_pil) for img_pil in imgs_pil])
+    if len(batch_paths) < pad_to:
+        padding = imgs_tensor.new_zeros((pad_to - len(batch_paths), *imgs_tensor.shape[1:]))
+        imgs_tensor = torch.cat([imgs_tensor, padding])
+    imgs_tensor = imgs_tensor.pin_memory()
+    with torch.cuda.stream(stream):
+        images_test = imgs_tensor.cuda(non_blocking=True)
+    return imgs_original_size, images_test
+
+
+@lru_cache(maxsize=None)
+def load_dataset_classes(dataset_split_path):
+    '''
+    list the classes of a dataset split, cached since all the analyzed images
+    usually come from the same split
+    '''
+    dataset = datasets.ImageFolder(dataset_split_path)
+    return dataset.classes, dataset.class_to_idx
+
 
+@lru_cache(maxsize=None)
+def load_part_locs(dataset_path):
+    return pd.read_csv(os.path.join(dataset_path, 'part_locs.csv'))
 
 
 def run_analysis(args: Namespace):
     os.environ['CUDA_VISIBLE_DEVICES'] = args.gpus
+    torch.backends.cudnn.benchmark = True
 
     # Compute params
-    img_path = os.path.abspath(args.img)  # ./datasets/celeb_a/gender/test/Male/1.jpg
-    img_class, img_id = re.split(r'\\|/', img_path)[-2:]
-    img_id, _ = os.path.splitext(img_id)
-    img_id = int(img_id)
-
-    dataset_split_path = os.path.dirname(os.path.dirname(img_path))
-    dataset_path = os.path.dirname(dataset_split_path)
-
-    model_path = os.path.abspath(args.model)  # ./saved_models/vgg19/003/checkpoints/10_18push0.7822.pth
-    model_base_architecture, experiment_run, _, model_name = re.split(r'\\|/', model_path)[-4:]
+    # an existing path is used as is, since file names may contain glob special characters
+    img_paths = [args.img] if os.path.exists(args.img) else glob.glob(args.img)
+    image_paths = sorted(Path(p).resolve() for p in img_paths)  # ./datasets/celeb_a/gender/test/Male/*.jpg
+    assert len(image_paths) > 0, f'No images found matching "{args.img}"'
+    assert args.batch_size > 0, 'Batch size must be a positive number'
+
+    model_path = Path(args.model).resolve()  # ./saved_models/vgg19/003/checkpoints/10_18push0.7822.pth
+    model_base_architecture, experiment_run, _, model_name = model_path.parts[-4:]
     start_epoch_number = int(re.search(r'\d+', model_name).group(0))
 
-    save_analysis_path = os.path.join(args.out, model_base_architecture, experiment_run, model_name, 'local', img_class, str(img_id))
-    makedir(save_analysis_path)
-    log, logclose = create_logger(log_filename=os.path.join(save_analysis_path, 'local_analysis.log'))
-
-    log(f'\nLoad model from: {args.model}')
-    log(f'Model epoch: {start_epoch_number}')
-    log(f'Model base architecture: {model_base_architecture}')
-    log(f'Experiment run: {experiment_run}\n')
+    ppnet = torch.load(args.model, map_location='cuda')
+    ppnet = ppnet.to(memory_format=torch.channels_last).eval()
+    conv_features = ppnet.conv_features
+    if args.compile:
+        assert hasattr(torch, 'compile'), 'Model compilation requires PyTorch 2.0 or later'
+        conv_features = torch.compile(conv_features, mode='max-autotune')
+    last_layer_np = ppnet.last_layer.weight.detach().cpu().numpy()
+    pci_np = ppnet.prototype_class_identity.detach().cpu().numpy()
 
-    ppnet = torch.load(args.model)
-    ppnet = ppnet.cuda()
-    ppnet_multi = torch.nn.DataParallel(ppnet)
-
-    img_pil = Image.open(args.img)
-    img_size = ppnet_multi.module.img_size
+    img_size = ppnet.img_size
     prototype_shape = ppnet.prototype_shape
     max_dist = prototype_shape[1] * prototype_shape[2] * prototype_shape[3]
     normalize = transforms.Normalize(mean=mean, std=std)
-    dataset = datasets.ImageFolder(dataset_split_path)
-
-    # Load part annotations
-    part_locs = pd.read_csv(os.path.join(dataset_path, 'part_locs.csv'))
-    part_locs = part_locs[part_locs.image_id == img_id].drop('image_id', axis=1).set_index('part_name').copy()
-    part_locs['x'] = (part_locs['x'] * (img_size / img_pil.width)).astype(int)  # Rescale part locations to match input size
-    part_locs['y'] = (part_locs['y'] * (img_size / img_pil.height)).astype(int)
-    assert np.all(part_locs[['x', 'y']] <= img_size), 'Part locations are outside of image boundaries'
-
-    # SANITY CHECK
-    # confirm prototype class identity
-    load_img_dir = os.path.join(os.path.dirname(args.model), '..', 'img')
-    assert os.path.exists(load_img_dir), f'Folder "{load_img_dir}" does not exist'
-    prototype_info = np.load(os.path.join(load_img_dir, f'epoch-{start_epoch_number}', 'bb.npy'))
-    prototype_img_identity = prototype_info[:, -1]
-    log('Prototypes are chosen from ' + str(len(set(prototype_img_identity))) + ' classes')
-
-    # confirm prototype connects most strongly to its own class
-    prototype_max_connection = torch.argmax(ppnet.last_layer.weight, dim=0)
-    prototype_max_connection = prototype_max_connection.cpu().numpy()
-    if np.sum(prototype_max_connection == prototype_img_identity) == ppnet.num_prototypes:
-        log('All prototypes connect strongly to their respective classes\n')
-    else:
-        log('WARNING: Not all prototypes connect most strongly to their respective classes\n')
-
-    # load the test image and forward it through the network
     preprocess = transforms.Compose([
         transforms.Resize((img_size, img_size)),
         transforms.ToTensor(),
         normalize
     ])
-    img_tensor = preprocess(img_pil)
-    img_variable = Variable(img_tensor.unsqueeze(0))
-
-    images_test = img_variable.cuda()
-    labels_test = torch.tensor([ dataset.class_to_idx[img_class] ])
-
-    logits, min_distances = ppnet_multi(images_test)
-    _, distances = ppnet.push_forward(images_test)
-    prototype_activations = ppnet.distance_2_similarity(min_distances)
-    prototype_activation_patterns = ppnet.distance_2_similarity(distances)
-    if ppnet.prototype_activation_function == 'linear':
-        prototype_activations = prototype_activations + max_dist
-        prototype_activation_patterns = prototype_activation_patterns + max_dist
-
-    tables = []
-    for i in range(logits.size(0)):
-        tables.append((torch.argmax(logits, dim=1)[i].item(), labels_test[i].item()))
-
-    idx = 0
-    predicted_cls = tables[idx][0]
-    correct_cls = tables[idx][1]
-    log('Predicted class: ' + str(predicted_cls))
-    log('Correct class: ' + str(correct_cls) + '\n')
-    original_img = save_preprocessed_img(os.path.join(save_analysis_path, 'original_img.png'), images_test, idx)
-
-    # MOST ACTIVATED (NEAREST) 10 PROTOTYPES OF THIS IMAGE
-    array_act, sorted_indices_act = torch.sort(prototype_activations[idx])
-    out_dir = os.path.join(save_analysis_path, 'most_activated_prototypes')
-    makedir(out_dir)
-    top_prototypes = min(args.top_prototypes, ppnet.num_prototypes)
-    alignment_matrix = pd.DataFrame(index=reversed(sorted_indices_act[-top_prototypes:]).cpu().numpy(), columns=part_locs.index)
-    for i in tqdm(range(1, top_prototypes + 1), desc='Computing most activated prototypes'):
-        save_prototype(load_img_dir, os.path.join(out_dir,  f'top-{i}_prototype_patch.png'), start_epoch_number, sorted_indices_act[-i].item())
-        save_prototype_original_img_with_bbox(
-            load_img_dir=load_img_dir,
-            fname=os.path.join(out_dir, f'top-{i}_prototype_bbox.png'),
-            epoch=start_epoch_number,
-            index=sorted_indices_act[-i].item(),
-            bbox_height_start=prototype_info[sorted_indices_act[-i].item()][1],
-            bbox_height_end=prototype_info[sorted_indices_act[-i].item()][2],
-            bbox_width_start=prototype_info[sorted_indices_act[-i].item()][3],
-            bbox_width_end=prototype_info[sorted_indices_act[-i].item()][4],
-            color=(0, 255, 255)
-        )
-        save_prototype_self_activation(load_img_dir, os.path.join(out_dir, f'top-{i}_prototype_activation.png'), start_epoch_number, sorted_indices_act[-i].item())
-        with open(os.path.join(out_dir, f'top-{i}_info.txt'), 'w') as f:
-            f.write('prototype index: {0}\n'.format(sorted_indices_act[-i].item()))
-            f.write('prototype class: {0}\n'.format(prototype_img_identity[sorted_indices_act[-i].item()]))
-            if prototype_max_connection[sorted_indices_act[-i].item()] != prototype_img_identity[sorted_indices_act[-i].item()]:
-                f.write('prototype connection: {0}\n'.format(prototype_max_connection[sorted_indices_act[-i].item()]))
-            f.write('activation value (similarity score): {0:.4f}\n'.format(array_act[-i]))
-            f.write('last layer connection with predicted class: {0:.4f}\n'.format(ppnet.last_layer.weight[predicted_cls][sorted_indices_act[-i].item()]))
-        activation_pattern = prototype_activation_patterns[idx][sorted_indices_act[-i].item()].detach().cpu().numpy()
-        upsampled_activation_pattern = cv2.resize(activation_pattern, dsize=(img_size, img_size), interpolation=cv2.INTER_CUBIC)
-        # Show the most highly activated patch of the image by this prototype
-        high_act_patch_indices = find_high_activation_crop(upsampled_activation_pattern)
-        high_act_y, high_act_x = np.mean(high_act_patch_indices[0:2], dtype=int), np.mean(high_act_patch_indices[2:4], dtype=int)
-        high_act_patch = original_img[high_act_patch_indices[0]:high_act_patch_indices[1], high_act_patch_indices[2]:high_act_patch_indices[3], :]
-        plt.axis('off')
-        plt.imsave(os.path.join(out_dir, f'top-{i}_target_patch.png'), high_act_patch)
-        imsave_with_bbox(fname=os.path.join(out_dir, f'top-{i}_target_bbox.png'),
-                         img_rgb=original_img,
-                         bbox_height_start=high_act_patch_indices[0],
-                         bbox_height_end=high_act_patch_indices[1],
-                         bbox_width_start=high_act_patch_indices[2],
-                         bbox_width_end=high_act_patch_indices[3], color=(0, 255, 255))
-        # Show the image overlayed with prototype activation map
-        rescaled_activation_pattern = upsampled_activation_pattern - np.amin(upsampled_activation_pattern)
-        rescaled_activation_pattern = rescaled_activation_pattern / np.amax(rescaled_activation_pattern)
-        heatmap = cv2.applyColorMap(np.uint8(255*rescaled_activation_pattern), cv2.COLORMAP_JET)
-        heatmap = np.float32(heatmap) / 255
-        heatmap = heatmap[..., ::-1]
-        overlayed_img = 0.5 * original_img + 0.3 * heatmap
-        plt.axis('off')
-        plt.imsave(os.path.join(out_dir, f'top-{i}_target_activations.png'), overlayed_img)
-        # Compute alignment matrix
-        dist = ((part_locs['x'] - high_act_x) ** 2 + (part_locs['y'] - high_act_y) ** 2) **.5
-        alignment_matrix.loc[sorted_indices_act[-i].item(), :] = dist
-    # TODO: save alignment matrix plot
-    # PROTOTYPES FROM TOP-k CLASSES
-    k = args.top_classes
-    assert k < len(dataset.classes), 'k must be less than the number of available classes'
-    log('Prototypes from top-%d classes:' % k)
-    topk_logits, topk_classes = torch.topk(logits[idx], k=k)
-    for i, c in enumerate(topk_classes.detach().cpu().numpy()):
-        class_dir = os.path.join(save_analysis_path, 'class_prototypes', f'top-{i+1}_class')
-        makedir(class_dir)
-        class_prototype_indices = np.nonzero(ppnet.prototype_class_identity.detach().cpu().numpy()[:, c])[0]
-        class_prototype_activations = prototype_activations[idx][class_prototype_indices]
-        _, sorted_indices_cls_act = torch.sort(class_prototype_activations)
-        prototype_cnt = 1
-        reversed_indices = list(reversed(sorted_indices_cls_act.detach().cpu().numpy()))
-        for j in tqdm(reversed_indices, desc=f'Computing prototypes of top-{i+1} class'):
-            prototype_index = class_prototype_indices[j]
-            save_prototype(load_img_dir, os.path.join(class_dir, f'top-{prototype_cnt}_prototype_patch.png'), start_epoch_number, prototype_index)
-            save_prototype_original_img_with_bbox(
-                load_img_dir=load_img_dir,
-                fname=os.path.join(class_dir, f'top-{prototype_cnt}_prototype_bbox.png'),
-                epoch=start_epoch_number,
-                index=prototype_index,
-                bbox_height_start=prototype_info[prototype_index][1],
-                bbox_height_end=prototype_info[prototype_index][2],
-                bbox_width_start=prototype_info[prototype_index][3],
-                bbox_width_end=prototype_info[prototype_index][4],
-                color=(0, 255, 255)
-            )
-            save_prototype_self_activation(load_img_dir, os.path.join(class_dir, f'top-{prototype_cnt}_prototype_activation.png'), start_epoch_number, prototype_index)
-            with open(os.path.join(class_dir, f'top-{prototype_cnt}_info.txt'), 'w') as f:
-                f.write('prototype index: {0}\n'.format(prototype_index))
-                f.write('prototype class: {0}\n'.format(prototype_img_identity[prototype_index]))
-                f.write('prototype class logits: {0:.4f}\n'.format(topk_logits[i]))
-                if prototype_max_connection[prototype_index] != prototype_img_identity[prototype_index]:
-                    f.write('prototype connection: {0}\n'.format(prototype_max_connection[prototype_index]))
-                f.write('activation value (similarity score): {0:.4f}\n'.format(prototype_activations[idx][prototype_index]))
-                f.write('last layer connection: {0:.4f}\n'.format(ppnet.last_layer.weight[c][prototype_index]))
-
-            activation_pattern = prototype_activation_patterns[idx][prototype_index].detach().cpu().numpy()
-            upsampled_activation_pattern = cv2.resize(activation_pattern, dsize=(img_size, img_size), interpolation=cv2.INTER_CUBIC)
-
-            # show the most highly activated patch of the image by this prototype
-            high_act_patch_indices = find_high_activation_crop(upsampled_activation_pattern)
-            high_act_patch = original_img[high_act_patch_indices[0]:high_act_patch_indices[1], high_act_patch_indices[2]:high_act_patch_indices[3], :]
-            plt.axis('off')
-            plt.imsave(os.path.join(class_dir, f'top-{prototype_cnt}_target_patch.png'), high_act_patch)
-            imsave_with_bbox(fname=os.path.join(class_dir, f'top-{prototype_cnt}_target_bbox.png'),
-                             img_rgb=original_img,
-                             bbox_height_start=high_act_patch_indices[0],
-                             bbox_height_end=high_act_patch_indices[1],
-                             bbox_width_start=high_act_patch_indices[2],
-                             bbox_width_end=high_act_patch_indices[3], color=(0, 255, 255))
-            # show the image overlayed with prototype activation map
-            rescaled_activation_pattern = upsampled_activation_pattern - np.amin(upsampled_activation_pattern)
-            rescaled_activation_pattern = rescaled_activation_pattern / np.amax(rescaled_activation_pattern)
-            heatmap = cv2.applyColorMap(np.uint8(255*rescaled_activation_pattern), cv2.COLORMAP_JET)
-            heatmap = np.float32(heatmap) / 255
-            heatmap = heatmap[..., ::-1]
-            overlayed_img = 0.5 * original_img + 0.3 * heatmap
-            plt.axis('off')
-            plt.imsave(os.path.join(class_dir, f'top-{prototype_cnt}_target_activation.png'), overlayed_img)
-            prototype_cnt += 1
-
-    if predicted_cls == correct_cls:
-        log('Prediction is correct.')
-    else:
-        log('Prediction is wrong.')
-
-    logclose()
+
+    load_img_dir = os.path.join(os.path.dirname(args.model), '..', 'img')
+    assert os.path.exists(load_img_dir), f'Folder "{load_img_dir}" does not exist'
+    prototype_info = np.load(os.path.join(load_img_dir, f'epoch-{start_epoch_number}', 'bb.npy'))
+    prototype_img_identity = prototype_info[:, -1]
+    prototype_bboxes = prototype_info[:, 1:5].astype(int).tolist()  # (height_start, height_end, width_start, width_end)
+    prototype_max_connection = np.argmax(last_layer_np, axis=0)
+
+    # PNG encoding releases the GIL, so the images are written concurrently
+    pool = ThreadPoolExecutor(max_workers=8)
+    # the compiled backbone is specialized on the batch shape, so pad the last batch to the size of the
+    # previous ones to avoid recompiling it (no padding is needed when all the images fit in one batch)
+    pad_to = min(args.batch_size, len(image_paths)) if args.compile else 0
+    copy_stream = torch.cuda.Stream()
+    next_batch = prefetch_test_batch(image_paths[:args.batch_size], preprocess, img_size, copy_stream, pad_to)
+    for batch_start in range(0, len(image_paths), args.batch_size):
+        # forward the test images through the network in a single batch
+        batch_paths = image_paths[batch_start:batch_start + args.batch_size]
+        imgs_original_size, images_test = next_batch
+        torch.cuda.current_stream().wait_stream(copy_stream)
+        images_test.record_stream(torch.cuda.current_stream())
+
+        with torch.inference_mode():
+            # only the backbone runs in half precision: the l2 distances subtract large
+            # terms, which would lose the small distances the similarity scores amplify
+            with torch.cuda.amp.autocast(enabled=args.half):
+                conv_output = conv_features(images_test.contiguous(memory_format=torch.channels_last))
+            distances = ppnet._l2_convolution(conv_output[:len(batch_paths)].float())
+            # same as ppnet.forward, but reusing the distances to avoid a second pass through the backbone
+            min_distances = -F.max_pool2d(-distances, kernel_size=(distances.size(2), distances.size(3)))
+            min_distances = min_distances.view(distances.size(0), -1)
+            prototype_activations = ppnet.distance_2_similarity(min_distances)
+            logits = ppnet.last_layer(prototype_activations)
+            prototype_activation_patterns = ppnet.distance_2_similarity(distances)
+        # load the next batch while the GPU is still running the forward of the current one
+        next_batch_start = batch_start + args.batch_size
+        if next_batch_start < len(image_paths):
+            next_batch_paths = image_paths[next_batch_start:next_batch_start + args.batch_size]
+            next_batch = prefetch_test_batch(next_batch_paths, preprocess, img_size, copy_stream, pad_to)
+        if ppnet.prototype_activation_function == 'linear':
+            prototype_activations = prototype_activations + max_dist
+            prototype_activation_patterns = prototype_activation_patterns + max_dist
+        activations_np = prototype_activations.detach().cpu().numpy()
+        predicted_classes = torch.argmax(logits, dim=1).cpu().numpy()
+
+        for idx, (img_path, (img_width, img_height)) in enumerate(zip(batch_paths, imgs_original_size)):
+            img_class, img_id = img_path.parts[-2], int(img_path.stem)
+            dataset_split_path = img_path.parents[1]
+            dataset_path = img_path.parents[2]
+
+            save_analysis_path = os.path.join(args.out, model_base_architecture, experiment_run, model_name, 'local', img_class, str(img_id))
+            makedir(save_analysis_path)
+            log, logclose = create_logger(log_filename=os.path.join(save_analysis_path, 'local_analysis.log'))
+
+            log(f'\nAnalyze image: {img_path}')
+            log(f'Load model from: {args.model}')
+            log(f'Model epoch: {start_epoch_number}')
+            log(f'Model base architecture: {model_base_architecture}')
+            log(f'Experiment run: {experiment_run}\n')
+
+            dataset_classes, class_to_idx = load_dataset_classes(dataset_split_path)
+
+            # Load part annotations
+            part_locs = load_part_locs(dataset_path)
+            part_locs = part_locs[part_locs.image_id == img_id].drop('image_id', axis=1).set_index('part_name').copy()
+            part_locs['x'] = (part_locs['x'] * (img_size / img_width)).astype(int)  # Rescale part locations to match input size
+            part_locs['y'] = (part_locs['y'] * (img_size / img_height)).astype(int)
+            assert np.all(part_locs[['x', 'y']] <= img_size), 'Part locations are outside of image boundaries'
+
+            # SANITY CHECK
+            # confirm prototype class identity
+            log('Prototypes are chosen from ' + str(len(set(prototype_img_identity))) + ' classes')
+
+            # confirm prototype connects most strongly to its own class
+            if np.sum(prototype_max_connection == prototype_img_identity) == ppnet.num_prototypes:
+                log('All prototypes connect strongly to their respective classes\n')
+            else:
+                log('WARNING: Not all prototypes connect most strongly to their respective classes\n')
+
+            predicted_cls = predicted_classes[idx]
+            correct_cls = class_to_idx[img_class]
+            log('Predicted class: ' + str(predicted_cls))
+            log('Correct class: ' + str(correct_cls) + '\n')
+            original_img = save_preprocessed_img(os.path.join(save_analysis_path, 'original_img.png'), images_test, idx)
+
+            # MOST ACTIVATED (NEAREST) PROTOTYPES OF THIS IMAGE
+            act_np = activations_np[idx]
+            sorted_indices_act = np.argsort(act_np)
+            top_prototypes = min(args.top_prototypes, ppnet.num_prototypes)
+            top_indices = sorted_indices_act[::-1][:top_prototypes]
+
+            # PROTOTYPES FROM TOP-k CLASSES
+            k = args.top_classes
+            assert k < len(dataset_classes), 'k must be less than the number of available classes'
+            topk_logits, topk_classes = torch.topk(logits[idx], k=k)
+            topk_logits, topk_classes = topk_logits.detach().cpu().numpy(), topk_classes.detach().cpu().numpy()
+            class_indices = []
+            for c in topk_classes:
+                class_prototype_indices = np.nonzero(pci_np[:, c])[0]
+                sorted_indices_cls_act = np.argsort(-act_np[class_prototype_indices])
+                class_indices.append(class_prototype_indices[sorted_indices_cls_act])
+
+            # Save the analysis of each displayed prototype only once in a temporary folder, even if it appears in multiple lists
+            all_indices = np.unique(np.concatenate([top_indices, *class_indices])).astype(int)
+            prototypes_dir = os.path.join(save_analysis_path, 'prototypes')
+            # the maps are processed in chunks to bound the GPU and host memory when many prototypes are displayed
+            high_act_crops = {}
+            progress = tqdm(total=len(all_indices), desc='Computing activated prototypes')
+            for chunk_start in range(0, len(all_indices), prototype_chunk_size):
+                chunk_indices = all_indices[chunk_start:chunk_start + prototype_chunk_size]
+                upsampled_activation_patterns = upsample_activation_patterns(prototype_activation_patterns[idx], chunk_indices, img_size)
+                overlayed_imgs = overlay_activation_heatmaps(original_img, upsampled_activation_patterns).detach().cpu().numpy()
+                chunk_crops = find_high_activation_crops(upsampled_activation_patterns).cpu().tolist()
+                futures = []
+                for j, prototype_index in enumerate(chunk_indices):
+                    futures.append(pool.submit(
+                        save_prototype_analysis,
+                        load_img_dir=load_img_dir,
+                        save_dir=os.path.join(prototypes_dir, str(prototype_index)),
+                        epoch=start_epoch_number,
+                        index=prototype_index,
+                        prototype_bbox=prototype_bboxes[prototype_index],
+                        original_img=original_img,
+                        high_act_patch_indices=chunk_crops[j],
+                        overlayed_img=overlayed_imgs[j]
+                    ))
+                for future in as_completed(futures):
+                    future.result()
+                    progress.update()
+                high_act_crops.update(zip(chunk_indices, chunk_crops))
+            progress.close()
+            futures = []
+
+            out_dir = os.path.join(save_analysis_path, 'most_activated_prototypes')
+            makedir(out_dir)
+            alignment_matrix = pd.DataFrame(index=top_indices, columns=part_locs.index)
+            for i, prototype_index in enumerate(top_indices, start=1):
+                futures.append(pool.submit(copy_prototype_analysis, os.path.join(prototypes_dir, str(prototype_index)), out_dir, prefix=f'top-{i}',
+                                            rename={'target_activation.png': 'target_activations.png'}))
+                with open(os.path.join(out_dir, f'top-{i}_info.txt'), 'w') as f:
+                    f.write('prototype index: {0}\n'.format(prototype_index))
+                    f.write('prototype class: {0}\n'.format(prototype_img_identity[prototype_index]))
+                    if prototype_max_connection[prototype_index] != prototype_img_identity[prototype_index]:
+                        f.write('prototype connection: {0}\n'.format(prototype_max_connection[prototype_index]))
+                    f.write('activation value (similarity score): {0:.4f}\n'.format(act_np[prototype_index]))
+                    f.write('last layer connection with predicted class: {0:.4f}\n'.format(last_layer_np[predicted_cls, prototype_index]))
+                # Compute alignment matrix
+                high_act_patch_indices = high_act_crops[prototype_index]
+                high_act_y, high_act_x = np.mean(high_act_patch_indices[0:2], dtype=int), np.mean(high_act_patch_indices[2:4], dtype=int)
+                dist = ((part_locs['x'] - high_act_x) ** 2 + (part_locs['y'] - high_act_y) ** 2) **.5
+                alignment_matrix.loc[prototype_index, :] = dist
+            # TODO: save alignment matrix plot
+
+            log('Prototypes from top-%d classes:' % k)
+            for i, (c, class_prototype_indices) in enumerate(zip(topk_classes, class_indices)):
+                class_dir = os.path.join(save_analysis_path, 'class_prototypes', f'top-{i+1}_class')
+                makedir(class_dir)
+                for prototype_cnt, prototype_index in enumerate(class_prototype_indices, start=1):
+                    futures.append(pool.submit(copy_prototype_analysis, os.path.join(prototypes_dir, str(prototype_index)), class_dir, prefix=f'top-{prototype_cnt}'))
+                    with open(os.path.join(class_dir, f'top-{prototype_cnt}_info.txt'), 'w') as f:
+                        f.write('prototype index: {0}\n'.format(prototype_index))
+                        f.write('prototype class: {0}\n'.format(prototype_img_identity[prototype_index]))
+                        f.write('prototype class logits: {0:.4f}\n'.format(topk_logits[i]))
+                        if prototype_max_connection[prototype_index] != prototype_img_identity[prototype_index]:
+                            f.write('prototype connection: {0}\n'.format(prototype_max_connection[prototype_index]))
+                        f.write('activation value (similarity score): {0:.4f}\n'.format(act_np[prototype_index]))
+                        f.write('last layer connection: {0:.4f}\n'.format(last_layer_np[c, prototype_index]))
+
+            for future in futures:
+                future.result()
+            shutil.rmtree(prototypes_dir, ignore_errors=True)
+
+            if predicted_cls == correct_cls:
+                log('Prediction is correct.')
+            else:
+                log('Prediction is wrong.')
+
+            logclose()
+    pool.shutdown(wait=True)